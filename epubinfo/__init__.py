@@ -1,29 +1,55 @@
 
 VERSION = '0.4.5'
 
-import zipfile, collections, os
-from xml.dom import minidom
+import zipfile, zlib, collections, copy, os, threading, weakref
 
 _DC_URI = "http://purl.org/dc/elements/1.1/"
 _OPF_URI = "http://www.idpf.org/2007/opf"
+_RENDITION_URI = "http://www.idpf.org/2013/rendition"
 
 class EpubInfoException(Exception):
 	"""Represents an exception due to a malformed epub file"""
 	pass
 
+# A validation issue found while parsing, `code` is a short machine readable string
+ValidationWarning = collections.namedtuple("ValidationWarning", ["code", "path", "message"])
+
+# Errors zipfile raises when reading a member that is damaged or can't be read
+_ZIP_MEMBER_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError)
+_ZIP_MEMBER_CODES = ("bad-crc", "unsupported-compression", "encrypted")
+
+# A media overlay clip: text (path#fragment) narrated by audio[begin:end] (seconds,
+# `end` is None when the clip plays until the end of the audio file)
+MediaClip = collections.namedtuple("MediaClip", ["text", "audio", "begin", "end"])
+
 class ManifestObj(object):
-	def __init__(self, epubobj, idname, href, media_type, properties=None):
+	def __init__(self, epubobj, idname, href, media_type, properties=None, media_overlay=None):
 		self.id = idname
 		self.href = href
 		self.media_type = media_type
 		self.properties = properties
+		self.media_overlay = media_overlay
 		self._epubobj = epubobj
 
+	@property
+	def path(self):
+		"""Full path of the item inside the ZIP file"""
+		from urllib.parse import unquote
+		# hrefs are URLs, ZIP member names are not percent-encoded
+		return os.path.normpath(os.path.join(os.path.dirname(
+			self._epubobj._opfpath), unquote(self.href)))
+
 	def content(self):
-		fullp = os.path.normpath(os.path.join(os.path.dirname(
-			self._epubobj._opfpath), self.href))
-		if fullp in self._epubobj._epubf.namelist():
-			return self._epubobj._epubf.read(fullp)
+		fullp = self.path
+		if fullp in self._epubobj._names:
+			return self._epubobj._read(fullp)
+		return None
+
+	def open(self):
+		"""Returns a seekable file object to read the item (or None if missing)"""
+		fullp = self.path
+		if fullp in self._epubobj._names:
+			return self._epubobj._open(fullp)
 		return None
 
 class SpineObj(object):
@@ -49,6 +75,9 @@ class EpubFile(object):
 	Args:
 		fileobj (obj): File Object of the file that will be processed.
 		getcover (boolean): Whether to extract the cover art from the book.
+		validate (boolean): Whether to collect validation warnings while parsing.
+		checkcrc (boolean): Whether to also verify the CRC of every ZIP member
+			(implies validate, requires reading the whole file).
 
 	Attributes:
 		title (str): Book title.
@@ -63,29 +92,54 @@ class EpubFile(object):
 		manifest (list): List of manifest items (objects).
 		spine (list): List of dicts that represent the book spine.
 		toc (list): List dicts that contain the book TOC.
+		renditions (list): Rendition list, one per OPF in the container (the
+			last one is the one parsed by this object).
+		warnings (list): ValidationWarning list (only if validating).
 	"""
-	def __init__(self, fileobj, getcover=False):
+	def __init__(self, fileobj, getcover=False, validate=False, checkcrc=False):
+		# Imported here to keep `import epubinfo` cheap for short-lived processes
+		from xml.dom import minidom
 		self._fileobj = fileobj
+		self._validate = validate or checkcrc
+		self.warnings = []
 		self._epubf = zipfile.ZipFile(fileobj, "r", allowZip64=True)
-		if "META-INF/container.xml" not in self._epubf.namelist():
+		# namelist() builds a new list on every call, keep a set around instead
+		self._names = set(self._epubf.namelist())
+		if self._validate:
+			self._check_zip(checkcrc)
+		# Archive level warnings, shared with the other renditions
+		self._zipwarnings = list(self.warnings)
+		if "META-INF/container.xml" not in self._names:
 			raise EpubInfoException("Missing META-INF/container.xml file")
 		# This XML file contains the path to the relevant metadata files
-		containerfile = self._epubf.read("META-INF/container.xml")
+		containerfile = self._read("META-INF/container.xml")
 		containerxmlf = minidom.parseString(containerfile)
-		# Look for the OPF file (absolute path)
-		self._opfpath = None
+		# Look for the OPF files (absolute path), there's one per rendition
+		self.renditions = []
 		for elem in containerxmlf.getElementsByTagName('rootfile'):
 			if elem.hasAttribute("full-path") and elem.hasAttribute("media-type"):
 				if elem.getAttribute("media-type") == "application/oebps-package+xml":
-					self._opfpath = elem.getAttribute("full-path")
+					self.renditions.append(Rendition(self, elem))
 
-		if self._opfpath is None:
+		if not self.renditions:
 			raise EpubInfoException("Can't locate the OPF file in the META-INF/container.xml file")
-		if self._opfpath not in self._epubf.namelist():
+		# For backwards compatibility the last rendition is the one parsed
+		self.renditions[-1]._book = self
+		self._getcover = getcover
+		self._parse_package(self.renditions[-1].path, getcover)
+
+	def _parse_package(self, opfpath, getcover):
+		from xml.dom import minidom
+		self._opfpath = opfpath
+		# Parsed MediaOverlay objects, by SMIL path
+		self._overlays = {}
+		if self._opfpath not in self._names:
 			raise EpubInfoException("The OPF file is missing in the ZIP file")
 
 		# Process the OPF file for metadata
-		opfxml = minidom.parseString(self._epubf.read(self._opfpath))
+		opfxml = minidom.parseString(self._read(self._opfpath))
+		if self._validate:
+			self._check_ids(opfxml)
 
 		# Read mandatory models
 		self._metadata = self._matchonemodel(opfxml, "metadata")
@@ -97,13 +151,18 @@ class EpubFile(object):
 		for child in manifest.getElementsByTagNameNS("*", "item"):
 			if all(child.hasAttribute(x) for x in  ["id", "href", "media-type"]):
 				itemid = child.getAttribute("id")
-				prop = None
+				prop, overlay = None, None
 				if child.hasAttribute("properties"):
 					prop = child.getAttribute("properties")
+				if child.hasAttribute("media-overlay"):
+					overlay = child.getAttribute("media-overlay")
 
 				elem = ManifestObj(self, itemid,
 					child.getAttribute("href"),
-					child.getAttribute("media-type"), prop)
+					child.getAttribute("media-type"), prop, overlay)
+				if self._validate and "://" not in elem.href and elem.path not in self._names:
+					self._warn("manifest-missing-file", elem.path,
+						"Manifest item `%s` is missing in the ZIP file" % itemid)
 				self.manifest[itemid] = elem
 
 		# Read the spine and its referenced TOC
@@ -121,14 +180,22 @@ class EpubFile(object):
 					prop = child.getAttribute("properties")
 
 				self.spine.append(SpineObj(self, idref, prop))
+				if self._validate and idref not in self.manifest:
+					self._warn("spine-missing-item", self._opfpath,
+						"Spine item `%s` is not in the manifest" % idref)
 
 		# Now parse the NCX TOC
 		self.toc = []
+		ncxfile = None
 		if self._spine_toc and self._spine_toc in self.manifest:
 			ncxfile = self.manifest[self._spine_toc].content()
+		if ncxfile is not None:
 			tocxml = minidom.parseString(ncxfile)
 			for navmap in tocxml.getElementsByTagNameNS("*", "navMap"):
 				self.toc += self._parseNavPoints(navmap.childNodes)
+		if self._validate and ncxfile is None and not any(
+			"nav" in (m.properties or "").split() for m in self.manifest.values()):
+			self._warn("missing-toc", self._opfpath, "The book has no navigation document nor NCX TOC")
 
 		# Proceed to process well-known fields (some are optional and return None)
 		self.titles = self._getmetamulti("title")
@@ -212,12 +279,132 @@ class EpubFile(object):
 					imgpath = m.href
 		# Extract the href of the image, and look it up in the zip file
 		if imgpath:
-			imgpath = os.path.normpath(os.path.join(os.path.dirname(self._opfpath), imgpath))
-			if imgpath in self._epubf.namelist():
+			from urllib.parse import unquote
+			imgpath = os.path.normpath(os.path.join(os.path.dirname(self._opfpath), unquote(imgpath)))
+			if imgpath in self._names:
 				self.cover_path = imgpath
 				if getcover:
-					self.cover = self._epubf.read(imgpath)
-
+					self.cover = self._read(imgpath)
+
+	def _rendition(self, opfpath):
+		# Builds an EpubFile for another OPF, sharing the archive handles and member index.
+		# Reads go through our own hooks, so pooled books keep using per-thread handles.
+		book = object.__new__(EpubFile)
+		book._fileobj = self._fileobj
+		book._epubf = self._epubf
+		book._names = self._names
+		book._validate = self._validate
+		book._getcover = self._getcover
+		book._zipwarnings = self._zipwarnings
+		book._read = self._read
+		book._open = self._open
+		book.renditions = self.renditions
+		book.warnings = list(self._zipwarnings)
+		book._parse_package(opfpath, self._getcover)
+		return book
+
+	def _warn(self, code, path, message):
+		self.warnings.append(ValidationWarning(code, path, message))
+
+	def _check_zip(self, checkcrc):
+		# The mimetype file must be the first one, uncompressed and with the right content
+		infos = self._epubf.infolist()
+		if "mimetype" not in self._names:
+			self._warn("mimetype-missing", "mimetype", "Missing mimetype file")
+		else:
+			if infos[0].filename != "mimetype":
+				self._warn("mimetype-not-first", "mimetype", "The mimetype file is not the first file")
+			if self._epubf.getinfo("mimetype").compress_type != zipfile.ZIP_STORED:
+				self._warn("mimetype-compressed", "mimetype", "The mimetype file is compressed")
+			else:
+				try:
+					if self._read("mimetype") != b"application/epub+zip":
+						self._warn("mimetype-content", "mimetype", "The mimetype file has unexpected content")
+				except _ZIP_MEMBER_ERRORS as e:
+					self._warn_member(self._epubf.getinfo("mimetype"), e)
+		if checkcrc:
+			# Streams every member (in chunks), zipfile checks the CRC at the end
+			warned = set(w.path for w in self.warnings if w.code in _ZIP_MEMBER_CODES)
+			for info in infos:
+				if info.filename in warned:
+					continue
+				try:
+					with self._open(info.filename) as fd:
+						while fd.read(1024 * 1024):
+							pass
+				except _ZIP_MEMBER_ERRORS as e:
+					self._warn_member(info, e)
+
+	def _warn_member(self, info, error):
+		# Unsupported compression raises NotImplementedError, encryption RuntimeError
+		if isinstance(error, NotImplementedError):
+			code = "unsupported-compression"
+		elif isinstance(error, RuntimeError):
+			code = "encrypted"
+		else:
+			code = "bad-crc"
+		self._warn(code, info.filename, str(error))
+
+	def _check_ids(self, opfxml):
+		seen = set()
+		for elem in opfxml.getElementsByTagName("*"):
+			if elem.hasAttribute("id"):
+				elemid = elem.getAttribute("id")
+				if elemid in seen:
+					self._warn("duplicate-id", self._opfpath, "Duplicated id `%s`" % elemid)
+				seen.add(elemid)
+
+	def _read(self, name):
+		# All member reads go through here (allows per-thread handles, see EpubFilePool)
+		return self._epubf.read(name)
+
+	def _open(self, name):
+		return self._epubf.open(name)
+
+	def media_overlay(self, itemid):
+		"""
+		Returns the MediaOverlay for the manifest item `itemid`.
+
+		Overlays are parsed once and cached. Returns None if the item has no
+		(valid) `media-overlay` attribute.
+		"""
+		item = self.manifest.get(itemid)
+		if item is None or item.media_overlay not in self.manifest:
+			return None
+		smil = self.manifest[item.media_overlay]
+		if smil.path not in self._names:
+			return None
+		overlay = self._overlays.get(smil.path)
+		if overlay is None:
+			overlay = self._overlays.setdefault(smil.path, MediaOverlay(self, smil.path))
+		return overlay
+
+	def to_dict(self):
+		"""
+		Returns the extracted metadata as a JSON-serializable dictionary.
+
+		Cover bytes are not included (only its path), and creator/contributor
+		roles are returned as sorted lists instead of sets.
+		"""
+		def humans(hmap):
+			return {
+				name: {k: sorted(v) if k == "role" else v for k, v in attrs.items()}
+				for name, attrs in hmap.items()
+			}
+		return {
+			"title": self.title,
+			"titles": self.titles,
+			"language": self.language,
+			"identifiers": self.identifiers,
+			"description": self.description,
+			"subjects": self.subjects,
+			"creators": humans(self.creators),
+			"contributors": humans(self.contributors),
+			"dates": self.dates,
+			"meta": self.meta,
+			"cover_path": self.cover_path,
+			"toc": self.toc,
+		}
 
 	def _matchonemodel(self, xmldoc, mname):
 		ret = xmldoc.getElementsByTagNameNS("*", mname)
@@ -326,8 +513,9 @@ class EpubFile(object):
 
 	# Generate a metadata OPF file with the updated metadata fields
 	def serialize_metadata(self):
+		from xml.dom import minidom
 		# Read original XML to update
-		opfxml = minidom.parseString(self._epubf.read(self._opfpath))
+		opfxml = minidom.parseString(self._read(self._opfpath))
 		metadata = self._matchonemodel(opfxml, "metadata")
 
 		# Ensure we have the relevant namespace prefixes
@@ -389,17 +577,435 @@ class EpubFile(object):
 
 	# Produce a new epub file with an updated (serialized) OPF file
 	def write_epub(self, fileobj):
-		with zipfile.ZipFile(self._fileobj, "r") as izip:
-			with zipfile.ZipFile(fileobj, "w", allowZip64=True) as ozip:
-				# Write mimetype (uncompressed!)
-				ozip.writestr("mimetype", b"application/epub+zip", compress_type=zipfile.ZIP_STORED)
+		with zipfile.ZipFile(fileobj, "w", allowZip64=True) as ozip:
+			# Write mimetype (uncompressed!)
+			ozip.writestr("mimetype", b"application/epub+zip", compress_type=zipfile.ZIP_STORED)
+
+			# Proceed to write the OPF
+			ozip.writestr(self._opfpath, self.serialize_metadata(), compress_type=zipfile.ZIP_DEFLATED)
+
+			# Now just copy all the other files (reading through our own handles)
+			written = set(["mimetype", self._opfpath])
+			for finfo in self._epubf.infolist():
+				if finfo.filename not in written:
+					written.add(finfo.filename)
+					# writestr() updates the ZipInfo it gets, so don't hand it our own
+					ozip.writestr(copy.copy(finfo), self._read(finfo.filename), compress_type=zipfile.ZIP_DEFLATED)
+
+class Rendition(object):
+	"""
+	A rendition (OPF file) listed in the META-INF/container.xml file.
+
+	The OPF is only parsed when `book` is first accessed. The resulting
+	EpubFile shares the archive handle with the EpubFile that listed it.
+
+	Attributes:
+		path (str): Full path to the OPF file in the ZIP file.
+		attributes (dict): Rendition selection attributes, such as `label`,
+			`language`, `accessMode`, `layout` or `media` (without prefix).
+	"""
+	def __init__(self, epubobj, elem):
+		self.path = elem.getAttribute("full-path")
+		self.attributes = {}
+		for (ns, name), value in elem.attributes.itemsNS():
+			if ns == _RENDITION_URI:
+				self.attributes[name] = value
+		self._epubobj = epubobj
+		self._book = None
+		self._lock = threading.Lock()
+
+	@property
+	def book(self):
+		"""EpubFile for this rendition (parsed on first access)"""
+		with self._lock:
+			if self._book is None:
+				self._book = self._epubobj._rendition(self.path)
+			return self._book
+
+def _parse_clock(value):
+	# Parses a SMIL clock value into seconds: "1:02:03.5", "02:03.5", "3.5s", "500ms"
+	if not value:
+		return None
+	value = value.strip()
+	try:
+		if ":" in value:
+			secs = 0.0
+			for part in value.split(":"):
+				secs = secs * 60 + float(part)
+			return secs
+		for suffix, mult in [("ms", 0.001), ("min", 60.0), ("h", 3600.0), ("s", 1.0)]:
+			if value.endswith(suffix):
+				return float(value[:-len(suffix)]) * mult
+		return float(value)
+	except ValueError:
+		raise EpubInfoException("Invalid SMIL clock value `%s`" % value)
+
+class MediaOverlay(object):
+	"""
+	Clip index of an EPUB3 media overlay (SMIL file).
 
-				# Proceed to write the OPF
-				ozip.writestr(self._opfpath, self.serialize_metadata(), compress_type=zipfile.ZIP_DEFLATED)
+	The SMIL document is parsed in streaming fashion, only keeping a compact
+	list of clips. Paths are resolved to full paths inside the ZIP file.
 
-				# Now just copy all the other files
-				for finfo in izip.infolist():
-					if finfo.filename not in ozip.namelist():
-						ozip.writestr(finfo, izip.read(finfo.filename), compress_type=zipfile.ZIP_DEFLATED)
+	Args:
+		epubobj (EpubFile): Book that contains the overlay.
+		smilpath (str): Full path of the SMIL file in the ZIP file.
+
+	Attributes:
+		clips (list): List of MediaClip, in document order.
+	"""
+	def __init__(self, epubobj, smilpath):
+		from xml.etree import ElementTree
+		self._epubobj = epubobj
+		self.clips = []
+		self._bytext = {}
+
+		from urllib.parse import unquote
+		basedir = os.path.dirname(smilpath)
+		def resolve(src):
+			path, _, frag = src.partition("#")
+			path = unquote(path)
+			fullp = os.path.normpath(os.path.join(basedir, path)) if path else smilpath
+			return fullp + "#" + frag if frag else fullp
+
+		text, audio = None, None
+		# Open elements, finished ones are detached from their parent so that
+		# the tree never holds more than the current path
+		parents = []
+		try:
+			with epubobj._open(smilpath) as smilf:
+				for event, elem in ElementTree.iterparse(smilf, events=("start", "end")):
+					tag = elem.tag.rsplit("}", 1)[-1]
+					if event == "start":
+						parents.append(elem)
+						if tag == "par":
+							text, audio = None, None
+						elif tag == "text" and "src" in elem.attrib:
+							text = resolve(elem.get("src"))
+						elif tag == "audio" and "src" in elem.attrib:
+							audio = (resolve(elem.get("src")),
+								_parse_clock(elem.get("clipBegin")) or 0.0,
+								_parse_clock(elem.get("clipEnd")))
+					else:
+						if tag == "par" and text and audio:
+							self._bytext.setdefault(text, len(self.clips))
+							self.clips.append(MediaClip(text, *audio))
+						parents.pop()
+						if parents:
+							parents[-1].remove(elem)
+		except ElementTree.ParseError as e:
+			raise EpubInfoException("Malformed SMIL file `%s`: %s" % (smilpath, e))
+
+	def __len__(self):
+		return len(self.clips)
+
+	def __iter__(self):
+		return iter(self.clips)
+
+	def clip(self, text):
+		"""Returns the first MediaClip for the text (full path#fragment), or None"""
+		idx = self._bytext.get(text)
+		return self.clips[idx] if idx is not None else None
+
+	def open_audio(self, clip):
+		"""Returns a seekable file object to the clip audio (None if missing)"""
+		if clip.audio not in self._epubobj._names:
+			return None
+		return self._epubobj._open(clip.audio)
+
+class SpineReader(object):
+	"""
+	Sequential reader for the spine items of an EpubFile.
+
+	Keeps the archive open and inflates the next spine items in a background
+	thread, so that reading chapters in order rarely waits for decompression.
+	Read items are kept in an LRU cache bounded by its size in bytes.
+
+	Args:
+		epubobj (EpubFile): Book to read the spine from.
+		prefetch (int): Number of spine items to prefetch ahead of the last read.
+		cachesize (int): Maximum number of bytes kept in the cache.
+	"""
+	def __init__(self, epubobj, prefetch=2, cachesize=32 * 1024 * 1024):
+		from concurrent.futures import ThreadPoolExecutor
+		self._epubobj = epubobj
+		self._prefetch = prefetch
+		self._cachesize = cachesize
+		self._cache = collections.OrderedDict()
+		self._cachebytes = 0
+		self._pending = {}
+		self._errors = {}
+		self._closed = False
+		self._lock = threading.Lock()
+		self._executor = ThreadPoolExecutor(max_workers=1)
+
+	def __len__(self):
+		return len(self._epubobj.spine)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		"""Stops the prefetching thread and drops the cache"""
+		with self._lock:
+			self._closed = True
+		self._executor.shutdown(wait=True)
+		with self._lock:
+			self._cache.clear()
+			self._cachebytes = 0
+			self._errors.clear()
+
+	def content(self, idx):
+		"""
+		Returns the content of the spine item at `idx` (or None if missing).
+
+		Errors hit while prefetching the item are raised here.
+		"""
+		if self._closed:
+			raise ValueError("Reading from a closed SpineReader")
+		spine = self._epubobj.spine
+		if idx < 0:
+			idx += len(spine)
+		if not 0 <= idx < len(spine):
+			raise IndexError("spine index out of range")
+
+		with self._lock:
+			if idx in self._errors:
+				raise self._errors.pop(idx)
+			if idx in self._cache:
+				self._cache.move_to_end(idx)
+				data = self._cache[idx]
+				future = None
+			else:
+				data, future = None, self._pending.get(idx)
+
+		if future is not None:
+			try:
+				data = future.result()
+			except Exception:
+				# Already reported to the caller, do not raise it twice
+				with self._lock:
+					self._errors.pop(idx, None)
+				raise
+		elif data is None:
+			data = self._load(idx)
+
+		for nidx in range(idx + 1, min(idx + 1 + self._prefetch, len(spine))):
+			with self._lock:
+				if self._closed:
+					break
+				if nidx in self._cache or nidx in self._pending or nidx in self._errors:
+					continue
+				self._pending[nidx] = self._executor.submit(self._load, nidx, True)
+		return data
+
+	def __getitem__(self, idx):
+		return self.content(idx)
+
+	def __iter__(self):
+		for idx in range(len(self)):
+			yield self.content(idx)
+
+	def _load(self, idx, prefetch=False):
+		data = None
+		try:
+			data = self._epubobj.spine[idx].content()
+		except Exception as e:
+			# Keep prefetch errors around, they are raised when the item is read
+			if prefetch:
+				with self._lock:
+					self._errors[idx] = e
+			raise
+		finally:
+			with self._lock:
+				if data is not None and idx not in self._cache:
+					self._cache[idx] = data
+					self._cachebytes += len(data)
+				if idx in self._cache:
+					self._cache.move_to_end(idx)
+				# Evict least recently used entries, but always keep the newest one
+				while self._cachebytes > self._cachesize and len(self._cache) > 1:
+					_, old = self._cache.popitem(last=False)
+					self._cachebytes -= len(old)
+				self._pending.pop(idx, None)
+		return data
+
+class _ThreadHandle(object):
+	# Holds a thread's ZipFile clone, closed (by a finalizer) when the thread exits
+	def __init__(self, zf):
+		self.zipfile = zf
+
+class _PooledEpubFile(EpubFile):
+	# EpubFile opened by path, where every thread reads through its own ZipFile
+	def __init__(self, path, getcover=False):
+		self.path = path
+		self._refs = 0
+		self._pooled = True
+		self._parsing = True
+		self._closed = False
+		self._local = threading.local()
+		self._clones = []
+		self._cloneslock = threading.Lock()
+		fd = open(path, "rb")
+		try:
+			stat = os.fstat(fd.fileno())
+			self._stamp = (stat.st_size, stat.st_mtime_ns)
+			self._identity = (stat.st_dev, stat.st_ino) + self._stamp
+			super().__init__(fd, getcover)
+		except:
+			fd.close()
+			raise
+		finally:
+			self._parsing = False
+
+	def _zipfile(self):
+		if self._closed:
+			raise ValueError("Reading from a closed book")
+		if self._parsing:
+			# No need for a second descriptor while the book is being parsed
+			return self._epubf
+		handle = getattr(self._local, "handle", None)
+		if handle is None:
+			zf = zipfile.ZipFile(self.path, "r", allowZip64=True)
+			# The path must still point to the very same file we parsed
+			stat = os.fstat(zf.fp.fileno())
+			if (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) != self._identity:
+				zf.close()
+				raise EpubInfoException("The file changed on disk after it was parsed")
+			with self._cloneslock:
+				self._clones.append(zf)
+			handle = self._local.handle = _ThreadHandle(zf)
+			weakref.finalize(handle, _PooledEpubFile._drop_clone, self._clones, self._cloneslock, zf)
+		return handle.zipfile
+
+	@staticmethod
+	def _drop_clone(clones, lock, zf):
+		with lock:
+			if zf in clones:
+				clones.remove(zf)
+		zf.close()
+
+	def _read(self, name):
+		return self._zipfile().read(name)
+
+	def _open(self, name):
+		return self._zipfile().open(name)
+
+	def _numfds(self):
+		with self._cloneslock:
+			return 1 + len(self._clones)
+
+	def close(self):
+		self._closed = True
+		with self._cloneslock:
+			for zf in self._clones:
+				zf.close()
+			del self._clones[:]
+		# Dropping the old handles runs their finalizers, which take the lock
+		self._local = threading.local()
+		self._epubf.close()
+		self._fileobj.close()
+
+class _PoolHandle(object):
+	def __init__(self, pool, path):
+		self._pool, self._path = pool, path
+
+	def __enter__(self):
+		self._book = self._pool.acquire(self._path)
+		return self._book
+
+	def __exit__(self, *args):
+		self._pool.release(self._book)
+
+class EpubFilePool(object):
+	"""
+	Thread-safe cache of parsed EpubFile objects, keyed by path.
 
+	Books are parsed once and shared by all threads, each thread reading the
+	archive members through its own file handle (closed when the thread
+	exits, so books in use hold one per live thread). Least recently used books
+	are closed when there are too many of them (or too many open files), as
+	long as they are not in use. Books modified on disk are parsed again.
+
+	Args:
+		maxbooks (int): Maximum number of books kept open.
+		maxfds (int): Maximum number of file descriptors used by the pool.
+		getcover (boolean): Whether to extract the cover art from the books.
+	"""
+	def __init__(self, maxbooks=128, maxfds=1024, getcover=False):
+		self._maxbooks = maxbooks
+		self._maxfds = maxfds
+		self._getcover = getcover
+		self._books = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._books)
+
+	def get(self, path):
+		"""Context manager that acquires (and later releases) the book at `path`"""
+		return _PoolHandle(self, path)
+
+	def acquire(self, path):
+		"""Returns the parsed EpubFile for `path`, must be paired with `release`"""
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		stamp = (stat.st_size, stat.st_mtime_ns)
+		with self._lock:
+			book = self._books.get(path)
+			if book is not None and book._stamp == stamp:
+				book._refs += 1
+				self._books.move_to_end(path)
+				return book
+
+		# Parse outside of the lock, if several threads race only one book is kept
+		newbook = _PooledEpubFile(path, self._getcover)
+		with self._lock:
+			book = self._books.get(path)
+			if book is not None and book._stamp == newbook._stamp:
+				newbook.close()
+			else:
+				if book is not None:
+					self._remove(path)
+				book = self._books[path] = newbook
+			book._refs += 1
+			self._books.move_to_end(path)
+			self._evict()
+			return book
+
+	def release(self, book):
+		"""Signals that a book returned by `acquire` is no longer used"""
+		with self._lock:
+			if book._refs <= 0:
+				raise ValueError("Book released more times than it was acquired")
+			book._refs -= 1
+			if not book._pooled and not book._refs:
+				book.close()
+			else:
+				self._evict()
+
+	def close(self):
+		"""Closes all the books (books in use are closed once released)"""
+		with self._lock:
+			for path in list(self._books):
+				self._remove(path)
+
+	def _remove(self, path):
+		book = self._books.pop(path)
+		book._pooled = False
+		if not book._refs:
+			book.close()
+
+	def _evict(self):
+		# Close unused books, least recently used first, until we are within limits
+		fds = sum(b._numfds() for b in self._books.values())
+		for path, book in list(self._books.items()):
+			if len(self._books) <= self._maxbooks and fds <= self._maxfds:
+				break
+			if not book._refs:
+				fds -= book._numfds()
+				self._remove(path)
 
@@ -0,0 +1,90 @@
+# Command line entry point: prints epub metadata as JSON (one line per file)
+#
+#   python -m epubinfo book1.epub book2.epub
+#   python -m epubinfo --serve /tmp/epubinfo.sock
+#
+# In serve mode the interpreter stays warm and every line received on the
+# UNIX socket is treated as a path, answered with a single JSON line.
+
+import sys, json, argparse
+import epubinfo
+
+def process_file(path, validate=False, checkcrc=False):
+	"""Returns a JSON-serializable dict with the metadata (or error) for a path"""
+	try:
+		with open(path, "rb") as fd:
+			book = epubinfo.EpubFile(fd, validate=validate, checkcrc=checkcrc)
+			ret = book.to_dict()
+			if validate or checkcrc:
+				ret["warnings"] = [w._asdict() for w in book.warnings]
+	except (OSError, epubinfo.EpubInfoException) as e:
+		return {"file": path, "error": str(e)}
+	except Exception as e:
+		# Bad zip files, malformed XML and so on
+		return {"file": path, "error": "%s: %s" % (type(e).__name__, e)}
+	ret["file"] = path
+	return ret
+
+def serve(sockpath, validate=False, checkcrc=False):
+	import os, stat, signal, socketserver, threading
+
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in self.rfile:
+				path = line.decode("utf-8").rstrip("\r\n")
+				if path:
+					resp = json.dumps(process_file(path, validate, checkcrc)) + "\n"
+					self.wfile.write(resp.encode("utf-8"))
+					self.wfile.flush()
+
+	class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+		daemon_threads = True
+
+	# Remove stale sockets from previous runs, but never anything else
+	try:
+		if not stat.S_ISSOCK(os.lstat(sockpath).st_mode):
+			sys.exit("epubinfo: %s exists and is not a socket" % sockpath)
+		os.unlink(sockpath)
+	except FileNotFoundError:
+		pass
+	with Server(sockpath, Handler) as server:
+		# shutdown() blocks until serve_forever() returns, so call it from another thread
+		signal.signal(signal.SIGTERM, lambda signum, frame:
+			threading.Thread(target=server.shutdown).start())
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			try:
+				os.unlink(sockpath)
+			except FileNotFoundError:
+				pass
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="epubinfo",
+		description="Extracts epub metadata and prints it as JSON")
+	parser.add_argument("files", nargs="*", help="epub files to process")
+	parser.add_argument("--validate", action="store_true",
+		help="Report structural issues found while parsing")
+	parser.add_argument("--check-crc", action="store_true",
+		help="Also verify the CRC of every ZIP member (implies --validate)")
+	parser.add_argument("--serve", metavar="SOCKET",
+		help="Listen on a UNIX socket for paths to process (one per line)")
+	args = parser.parse_args(argv)
+
+	if args.serve:
+		serve(args.serve, args.validate, args.check_crc)
+		return 0
+	if not args.files:
+		parser.error("no input files")
+
+	ok = True
+	for path in args.files:
+		res = process_file(path, args.validate, args.check_crc)
+		ok = ok and "error" not in res
+		print(json.dumps(res))
+	return 0 if ok else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
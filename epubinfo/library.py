@@ -0,0 +1,229 @@
+# Incremental indexer for directories full of epub files
+#
+#   python -m epubinfo.library index.json ~/books [--workers 4] [--watch 60]
+#
+# Keeps a JSON state file with the extracted metadata of every book, together
+# with its inode, size, mtime and a digest of the ZIP central directory. Only
+# new and changed books are opened and parsed on each run.
+
+import os, sys, json, time, hashlib, zipfile, argparse, collections
+import epubinfo
+
+def _extract(path):
+	# Runs in the worker processes, returns the metadata (or error) of a book
+	try:
+		with open(path, "rb") as fd:
+			return {"metadata": epubinfo.EpubFile(fd).to_dict()}
+	except Exception as e:
+		return {"error": "%s: %s" % (type(e).__name__, e)}
+
+def central_directory_digest(path):
+	"""
+	Returns a digest of the ZIP central directory (names, CRCs and sizes).
+
+	Only the central directory is read, which is enough to tell whether the
+	book contents changed (ie. it was not just touched or copied over).
+	Returns None if the file is not a valid ZIP file.
+	"""
+	h = hashlib.sha1()
+	try:
+		with zipfile.ZipFile(path, "r", allowZip64=True) as zf:
+			for info in zf.infolist():
+				h.update(("%s\0%08x\0%d\0" % (info.filename, info.CRC, info.file_size)).encode("utf-8"))
+	except (OSError, zipfile.BadZipFile):
+		return None
+	return h.hexdigest()
+
+class LibraryIndex(object):
+	"""
+	Incremental metadata index for one or more directories.
+
+	Every `update` walks the directories (only calling stat on the files),
+	and re-extracts the books that are new or whose contents changed. Books
+	are processed by a pool of worker processes, smaller files first so that
+	small updates land quickly. A book that crashes its worker is recorded
+	with an error, without affecting the rest of the batch.
+
+	Args:
+		statepath (str): JSON file where the index is stored (and loaded from).
+		roots (list): Directories to index.
+		workers (int): Number of worker processes, 0 to process inline.
+
+	Attributes:
+		books (dict): Path to entry dict, with `inode`, `size`, `mtime`,
+			`digest` and either `metadata` or `error`.
+	"""
+	def __init__(self, statepath, roots, workers=4):
+		self._statepath = statepath
+		self._roots = [os.path.abspath(r) for r in roots]
+		self._workers = workers
+		self.books = {}
+		if os.path.exists(statepath):
+			with open(statepath, "r") as fd:
+				self.books = json.load(fd)
+
+	def scan(self):
+		"""
+		Walks the directories and compares them to the index.
+
+		Returns a (new, changed, deleted, stats) tuple, with the lists of paths
+		and a dict of path to stat result for the new and changed books.
+		"""
+		new, changed, stats = [], [], {}
+		seen = set()
+		for root in self._roots:
+			for bpath, _, sfiles in os.walk(root):
+				for fn in sfiles:
+					if not fn.lower().endswith(".epub"):
+						continue
+					path = os.path.join(bpath, fn)
+					try:
+						st = os.stat(path)
+					except OSError:
+						# Possibly transient, keep whatever we had until the next run
+						if path in self.books:
+							seen.add(path)
+						continue
+					seen.add(path)
+					entry = self.books.get(path)
+					if entry is None:
+						new.append(path)
+						stats[path] = st
+					elif (entry["inode"], entry["size"], entry["mtime"]) != (st.st_ino, st.st_size, st.st_mtime_ns):
+						changed.append(path)
+						stats[path] = st
+		deleted = [p for p in self.books if p not in seen and
+			any(p.startswith(os.path.join(r, "")) for r in self._roots)]
+		return new, changed, deleted, stats
+
+	def update(self):
+		"""
+		Brings the index up to date, and saves it.
+
+		Returns a dict with the `new`, `changed` and `deleted` paths. Books
+		that were touched but whose central directory is unchanged are not
+		re-extracted, and are not reported as changed.
+		"""
+		new, changed, deleted, stats = self.scan()
+		for path in deleted:
+			del self.books[path]
+
+		# Stat changes alone are not enough, check whether the contents changed
+		pending, digests = [], {}
+		for path in new + changed:
+			digests[path] = central_directory_digest(path)
+			entry = self.books.get(path)
+			if entry is not None and digests[path] is not None and entry["digest"] == digests[path]:
+				st = stats[path]
+				entry.update({"inode": st.st_ino, "size": st.st_size, "mtime": st.st_mtime_ns})
+			else:
+				pending.append(path)
+		changed = [p for p in changed if p in pending]
+
+		# Small books first, large ones are scheduled last
+		pending.sort(key=lambda p: stats[p].st_size)
+		try:
+			for path, res in self._run(pending):
+				st = stats[path]
+				res.update({"inode": st.st_ino, "size": st.st_size, "mtime": st.st_mtime_ns,
+					"digest": digests[path]})
+				self.books[path] = res
+		finally:
+			# Keep whatever was extracted, even if interrupted
+			if stats or deleted:
+				self.save()
+		return {"new": new, "changed": changed, "deleted": deleted}
+
+	def _run(self, paths):
+		# Yields (path, result) tuples as soon as results are available
+		if not self._workers:
+			for path in paths:
+				yield path, _extract(path)
+			return
+		from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+		from concurrent.futures.process import BrokenProcessPool
+		order = {path: i for i, path in enumerate(paths)}
+		queue = collections.deque(paths)
+		while queue:
+			# Only as many books as workers are in flight, so that when a worker
+			# dies (crash, OOM kill...) and takes the pool down with it, we know
+			# which books could be the culprit.
+			running, broken = {}, []
+			with ProcessPoolExecutor(max_workers=self._workers) as executor:
+				while queue or running:
+					try:
+						while queue and len(running) < self._workers:
+							running[executor.submit(_extract, queue[0])] = queue[0]
+							queue.popleft()
+					except BrokenProcessPool:
+						if not running:
+							break
+					done, _ = wait(running, return_when=FIRST_COMPLETED)
+					for future in done:
+						path = running.pop(future)
+						try:
+							res = future.result()
+						except BrokenProcessPool:
+							broken.append(path)
+							continue
+						yield path, res
+					if broken:
+						broken.extend(running.values())
+						break
+			# Retry the books that were running one by one, to pin it on the right
+			# one, and carry on with a new pool for the rest
+			for path in sorted(broken, key=order.get):
+				yield path, self._run_isolated(path)
+
+	def _run_isolated(self, path):
+		from concurrent.futures import ProcessPoolExecutor
+		from concurrent.futures.process import BrokenProcessPool
+		with ProcessPoolExecutor(max_workers=1) as executor:
+			try:
+				return executor.submit(_extract, path).result()
+			except BrokenProcessPool as e:
+				return {"error": "BrokenProcessPool: worker died processing the book (%s)" % e}
+
+	def save(self):
+		"""Writes the index to its state file (atomically)"""
+		tmppath = self._statepath + ".tmp"
+		with open(tmppath, "w") as fd:
+			json.dump(self.books, fd)
+		os.replace(tmppath, self._statepath)
+
+	def watch(self, interval=60.0, callback=None):
+		"""Updates the index every `interval` seconds, calling `callback` with the changes"""
+		while True:
+			changes = self.update()
+			if callback and any(changes.values()):
+				callback(changes)
+			time.sleep(interval)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="epubinfo.library",
+		description="Incrementally indexes the epub files in some directories")
+	parser.add_argument("state", help="JSON file that holds the index")
+	parser.add_argument("roots", nargs="+", help="Directories to index")
+	parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--watch", type=float, metavar="SECONDS",
+		help="Keep running, updating the index every SECONDS")
+	args = parser.parse_args(argv)
+
+	def report(changes):
+		for kind in ["new", "changed", "deleted"]:
+			for path in changes[kind]:
+				print("%s %s" % (kind, path))
+		sys.stdout.flush()
+
+	index = LibraryIndex(args.state, args.roots, args.workers)
+	if args.watch:
+		try:
+			index.watch(args.watch, report)
+		except KeyboardInterrupt:
+			pass
+	else:
+		report(index.update())
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
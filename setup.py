@@ -18,4 +18,7 @@ setuptools.setup(
 	version=VERSION,
 	test_suite="tests",
 	packages=setuptools.find_packages(),
+	entry_points={
+		"console_scripts": ["epubinfo = epubinfo.__main__:main"],
+	},
 )
@@ -1,5 +1,6 @@
 
-import os, unittest, io, zipfile, hashlib
+import os, unittest, io, zipfile, hashlib, tempfile, time
+from unittest import mock
 import epubinfo
 import tests.data as testdata
 
@@ -149,3 +150,577 @@ class EpubTestFiles(unittest.TestCase):
 					self.assertEqual(meta1.contributors, meta3.contributors)
 					self.assertEqual(meta1.meta, meta3.meta)
 
+
+	def test_cli_json(self):
+		import json, tempfile, contextlib, subprocess, sys
+		import epubinfo.__main__ as cli
+		basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'moby-dick')
+		with tempfile.TemporaryDirectory() as tmpdir:
+			epubpath = os.path.join(tmpdir, "book.epub")
+			with open(epubpath, "wb") as fd:
+				self._gen_epub(fd, basepath)
+			with io.StringIO() as out, contextlib.redirect_stdout(out):
+				self.assertEqual(cli.main([epubpath, os.path.join(tmpdir, "missing.epub")]), 1)
+				lines = out.getvalue().splitlines()
+			res = [json.loads(l) for l in lines]
+			self.assertEqual(res[0]["file"], epubpath)
+			self.assertEqual(res[0]["title"], testdata.TEST_METADATA["moby-dick"]["title"])
+			self.assertIn("error", res[1])
+
+		# Importing the module should not pull the XML parser in
+		out = subprocess.check_output([sys.executable, "-c",
+			"import sys, epubinfo; print('xml.dom.minidom' in sys.modules)"])
+		self.assertEqual(out.strip(), b"False")
+
+	def test_spine_reader(self):
+		for testf, refdata in testdata.TEST_CONTENT.items():
+			basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', testf)
+			with io.BytesIO() as fakefile:
+				self._gen_epub(fakefile, basepath)
+				res = epubinfo.EpubFile(fakefile)
+				# A tiny cache forces evictions while reading
+				with epubinfo.SpineReader(res, prefetch=2, cachesize=1024) as reader:
+					self.assertEqual(len(reader), len(refdata["spine"]))
+					for i, content in enumerate(reader):
+						self.assertEqual(refdata["spine"][i]["content"], hashlib.sha256(content).hexdigest())
+					# Random access (and reading back evicted items) works too
+					for i in reversed(range(len(reader))):
+						self.assertEqual(reader[i], res.spine[i].content())
+					self.assertTrue(reader._cachebytes <= 1024 or len(reader._cache) == 1)
+
+	def test_pool(self):
+		import tempfile, threading
+		with tempfile.TemporaryDirectory() as tmpdir:
+			paths = []
+			for testf in testdata.TEST_CONTENT:
+				paths.append(os.path.join(tmpdir, testf + ".epub"))
+				with open(paths[-1], "wb") as fd:
+					self._gen_epub(fd, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', testf))
+
+			pool = epubinfo.EpubFilePool(maxbooks=2)
+			errors = []
+			def worker():
+				try:
+					for _ in range(5):
+						for path, testf in zip(paths, testdata.TEST_CONTENT):
+							with pool.get(path) as book:
+								for i, it in enumerate(testdata.TEST_CONTENT[testf]["spine"]):
+									self.assertEqual(it["content"], hashlib.sha256(book.spine[i].content()).hexdigest())
+				except Exception as e:
+					errors.append(e)
+			threads = [threading.Thread(target=worker) for _ in range(4)]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			self.assertEqual(errors, [])
+			self.assertLessEqual(len(pool), 2)
+
+			# Several threads repacking the same book concurrently
+			book = pool.acquire(paths[0])
+			def writer():
+				try:
+					for _ in range(5):
+						with io.BytesIO() as out:
+							book.write_epub(out)
+							copy = epubinfo.EpubFile(out)
+							self.assertEqual(copy.title, book.title)
+							for sobj in copy.spine:
+								sobj.content()
+				except Exception as e:
+					errors.append(e)
+			threads = [threading.Thread(target=writer) for _ in range(8)]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			self.assertEqual(errors, [])
+			pool.release(book)
+
+			# The same parsed book is handed out until the file changes
+			b1 = pool.acquire(paths[0])
+			pool.release(b1)
+			self.assertIs(pool.acquire(paths[0]), b1)
+			pool.release(b1)
+			with self.assertRaisesRegex(ValueError, "released more times"):
+				pool.release(b1)
+			b1 = pool.acquire(paths[0])
+			with open(paths[0], "ab") as fd:
+				fd.write(b"\0")
+			os.utime(paths[0], ns=(0, 0))
+			# Threads can't open new handles on a file that changed under the book
+			with self.assertRaisesRegex(epubinfo.EpubInfoException, "changed on disk"):
+				b1.serialize_metadata()
+			pool.release(b1)
+			b2 = pool.acquire(paths[0])
+			self.assertIsNot(b1, b2)
+			pool.release(b2)
+			pool.close()
+			self.assertEqual(len(pool), 0)
+			# Closed books (and their renditions) can't be read from anymore
+			for b in [b2, b2.renditions[0].book]:
+				with self.assertRaisesRegex(ValueError, "closed"):
+					b.serialize_metadata()
+			self.assertEqual(b2._numfds(), 1)
+
+	def test_media_overlay(self):
+		with io.BytesIO() as fakefile:
+			with zipfile.ZipFile(fakefile, "w") as zf:
+				zf.writestr("META-INF/container.xml",
+					"""<?xml version="1.0" encoding="UTF-8"?>
+					<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+						<rootfiles>
+							<rootfile full-path="EPUB/package.opf" media-type="application/oebps-package+xml"/>
+						</rootfiles>
+					</container>""")
+				zf.writestr("EPUB/package.opf",
+					"""<?xml version="1.0" encoding="UTF-8"?>
+					<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+						<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Overlay</dc:title></metadata>
+						<manifest>
+							<item id="c1" href="text/c1.xhtml" media-type="application/xhtml+xml" media-overlay="c1mo"/>
+							<item id="c1mo" href="smil/c1.smil" media-type="application/smil+xml"/>
+							<item id="audio" href="audio/c1.mp3" media-type="audio/mpeg"/>
+						</manifest>
+						<spine><itemref idref="c1"/></spine>
+					</package>""")
+				zf.writestr("EPUB/text/c1.xhtml", "<html/>")
+				zf.writestr("EPUB/smil/c1.smil",
+					"""<smil xmlns="http://www.w3.org/ns/SMIL" version="3.0"><body>
+						<seq epub:textref="../text/c1.xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+							<par id="p1"><text src="../text/c1.xhtml#s1"/>
+								<audio src="../audio/c1.mp3" clipBegin="0:00:01.5" clipEnd="0:00:03.000"/></par>
+							<par id="p2"><text src="../text/c1.xhtml#s2"/>
+								<audio src="../audio/c1.mp3" clipBegin="3s" clipEnd="4500ms"/></par>
+							<par id="p3"><text src="../text/c1.xhtml#s3"/>
+								<audio src="../audio/c2.mp3" clipEnd="2.5"/></par>
+						</seq></body></smil>""")
+				zf.writestr("EPUB/audio/c1.mp3", bytes(range(256)) * 16, compress_type=zipfile.ZIP_STORED)
+
+			res = epubinfo.EpubFile(fakefile)
+			self.assertEqual(res.manifest["c1"].media_overlay, "c1mo")
+			self.assertIsNone(res.media_overlay("audio"))
+			mo = res.media_overlay("c1")
+			self.assertEqual(list(mo), [
+				epubinfo.MediaClip("EPUB/text/c1.xhtml#s1", "EPUB/audio/c1.mp3", 1.5, 3.0),
+				epubinfo.MediaClip("EPUB/text/c1.xhtml#s2", "EPUB/audio/c1.mp3", 3.0, 4.5),
+				epubinfo.MediaClip("EPUB/text/c1.xhtml#s3", "EPUB/audio/c2.mp3", 0.0, 2.5),
+			])
+			self.assertIs(res.media_overlay("c1"), mo)
+			clip = mo.clip("EPUB/text/c1.xhtml#s2")
+			with mo.open_audio(clip) as audiof:
+				audiof.seek(1000)
+				self.assertEqual(audiof.read(4), bytes([232, 233, 234, 235]))
+
+	def test_fuzz_harness(self):
+		import tests.fuzz as fuzz
+		seeds = fuzz.build_seeds()
+		data = fuzz.pack(seeds["moby-dick"])
+		self.assertEqual(fuzz.run_case(data, trackmem=False)["outcome"], "ok")
+
+		# Unexpected exceptions are reported (once per signature)
+		orig = epubinfo.EpubFile.serialize_metadata
+		def broken(self):
+			raise ValueError("injected")
+		epubinfo.EpubFile.serialize_metadata = broken
+		try:
+			res = fuzz.run_case(data, trackmem=False)
+		finally:
+			epubinfo.EpubFile.serialize_metadata = orig
+		self.assertEqual(res["outcome"], "error")
+		self.assertIn("ValueError", res["signature"])
+		seen = set()
+		self.assertTrue(fuzz.triage(res, 30.0, 1 << 30, seen))
+		self.assertFalse(fuzz.triage(res, 30.0, 1 << 30, seen))
+		# EpubInfoException is an expected outcome
+		res = fuzz.run_case(fuzz.pack({"foo.txt": b"bar"}), trackmem=False)
+		self.assertEqual(res["outcome"], "rejected")
+		self.assertFalse(fuzz.triage(res, 30.0, 1 << 30, seen))
+
+		# A huge metadata section is slow, and is always kept
+		members = dict(seeds["cc-shared-culture"])
+		self.assertIn(b"</metadata>", members["EPUB/package.opf"])
+		members["EPUB/package.opf"] = members["EPUB/package.opf"].replace(b"</metadata>",
+			b'<meta property="p" refines="#c">v</meta>' * 2000 + b"</metadata>")
+		res = fuzz.run_case(fuzz.pack(members), trackmem=False)
+		self.assertGreater(res["time"], 0.05)
+		self.assertTrue(fuzz.triage(res, 0.05, 1 << 30, seen))
+		self.assertTrue(fuzz.triage(res, 0.05, 1 << 30, seen))
+
+	@unittest.skipUnless(hasattr(os, "fork"), "needs fork to patch the worker")
+	def test_fuzz_runner(self):
+		import tests.fuzz as fuzz
+		data = fuzz.pack(fuzz.build_seeds()["moby-dick"])
+		with fuzz.CaseRunner(timeout=1.0, trackmem=False) as runner:
+			res = runner.run(data)
+			self.assertEqual(res["outcome"], "ok")
+
+			# Hangs and dead workers are reported, and the worker restarted
+			with mock.patch.object(epubinfo.EpubFile, "serialize_metadata", lambda self: time.sleep(30)):
+				runner.close()
+				res = runner.run(data)
+			self.assertEqual(res["outcome"], "timeout")
+			self.assertTrue(fuzz.triage(res, 30.0, 1 << 30, set()))
+			with mock.patch.object(epubinfo.EpubFile, "serialize_metadata", lambda self: os._exit(3)):
+				res = runner.run(data)
+			self.assertEqual((res["outcome"], res["signature"]), ("crash", "Worker exited with code 3"))
+			seen = set()
+			self.assertTrue(fuzz.triage(res, 30.0, 1 << 30, seen))
+			self.assertFalse(fuzz.triage(res, 30.0, 1 << 30, seen))
+			self.assertEqual(runner.run(data)["outcome"], "ok")
+
+		# Replaying reports inputs that got slower than recorded, or started failing
+		with tempfile.TemporaryDirectory() as corpus:
+			fast = dict(res, outcome="ok", time=0.0)
+			fuzz.save_case(corpus, data, "fast", fast)
+			fuzz.save_case(corpus, fuzz.pack({"foo.txt": b"bar"}), "slow", dict(res, outcome="rejected", time=1000.0))
+			log = io.StringIO()
+			with mock.patch.object(epubinfo.EpubFile, "serialize_metadata", lambda self: time.sleep(0.05)):
+				regressions = fuzz.replay(corpus, log, trackmem=False)
+			self.assertEqual(len(regressions), 1)
+			self.assertEqual(regressions[0][0], hashlib.sha256(data).hexdigest()[:16] + ".epub")
+			self.assertIn("was 0.000s", regressions[0][1])
+			with mock.patch.object(epubinfo.EpubFile, "serialize_metadata", lambda self: 1 / 0):
+				regressions = fuzz.replay(corpus, log, trackmem=False)
+			self.assertIn("error, was ok", regressions[0][1])
+
+	def test_validate(self):
+		basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'covertest')
+		with io.BytesIO() as fakefile:
+			with zipfile.ZipFile(fakefile, "w") as zf:
+				zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+			with zipfile.ZipFile(fakefile, "a") as zf:
+				for bpath, _, sfiles in os.walk(basepath):
+					for fn in sfiles:
+						zf.write(os.path.join(bpath, fn), os.path.join(bpath[len(basepath) + 1:], fn))
+			res = epubinfo.EpubFile(fakefile, checkcrc=True)
+			self.assertEqual(res.warnings, [])
+			# Not validating does not collect anything
+			self.assertEqual(epubinfo.EpubFile(fakefile).warnings, [])
+
+		with io.BytesIO() as fakefile:
+			with zipfile.ZipFile(fakefile, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+				zf.writestr("META-INF/container.xml",
+					"""<?xml version="1.0" encoding="UTF-8"?>
+					<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+						<rootfiles>
+							<rootfile full-path="package.opf" media-type="application/oebps-package+xml"/>
+						</rootfiles>
+					</container>""")
+				zf.writestr("mimetype", "application/epub+zip")
+				zf.writestr("package.opf",
+					"""<?xml version="1.0" encoding="UTF-8"?>
+					<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+						<metadata/>
+						<manifest>
+							<item id="c1" href="c1.xhtml" media-type="application/xhtml+xml"/>
+							<item id="c1" href="c2.xhtml" media-type="application/xhtml+xml"/>
+							<item id="c3" href="c3.xhtml" media-type="application/xhtml+xml"/>
+						</manifest>
+						<spine><itemref idref="c1"/><itemref idref="c4"/></spine>
+					</package>""")
+				zf.writestr("c2.xhtml", "<html>" + "x" * 1000 + "</html>", compress_type=zipfile.ZIP_STORED)
+			# Corrupt the stored chapter so that its CRC no longer matches
+			data = fakefile.getvalue().replace(b"x" * 1000, b"y" * 1000)
+
+		res = epubinfo.EpubFile(io.BytesIO(data), validate=True)
+		self.assertEqual([(w.code, w.path) for w in res.warnings], [
+			("mimetype-not-first", "mimetype"),
+			("mimetype-compressed", "mimetype"),
+			("duplicate-id", "package.opf"),
+			("manifest-missing-file", "c1.xhtml"),
+			("manifest-missing-file", "c3.xhtml"),
+			("spine-missing-item", "package.opf"),
+			("missing-toc", "package.opf"),
+		])
+		res = epubinfo.EpubFile(io.BytesIO(data), checkcrc=True)
+		self.assertIn(("bad-crc", "c2.xhtml"), [(w.code, w.path) for w in res.warnings])
+
+		# Manifest hrefs are URLs, percent-encoded names refer to the plain member name
+		with io.BytesIO() as fakefile:
+			with zipfile.ZipFile(fakefile, "w") as zf:
+				zf.writestr("mimetype", "application/epub+zip")
+				zf.writestr("META-INF/container.xml",
+					"""<?xml version="1.0" encoding="UTF-8"?>
+					<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+						<rootfiles>
+							<rootfile full-path="OPS/package.opf" media-type="application/oebps-package+xml"/>
+						</rootfiles>
+					</container>""")
+				zf.writestr("OPS/package.opf",
+					"""<?xml version="1.0" encoding="UTF-8"?>
+					<package xmlns="http://www.idpf.org/2007/opf" version="3.0">
+						<metadata/>
+						<manifest>
+							<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+							<item id="c1" href="my%20chapter.xhtml" media-type="application/xhtml+xml"/>
+						</manifest>
+						<spine><itemref idref="c1"/></spine>
+					</package>""")
+				zf.writestr("OPS/nav.xhtml", "<html/>")
+				zf.writestr("OPS/my chapter.xhtml", "<html>chapter</html>")
+			res = epubinfo.EpubFile(fakefile, validate=True)
+			self.assertEqual(res.manifest["c1"].path, "OPS/my chapter.xhtml")
+			self.assertEqual(res.spine[0].content(), b"<html>chapter</html>")
+			self.assertNotIn("manifest-missing-file", [w.code for w in res.warnings])
+
+	def test_renditions(self):
+		basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'WCAG')
+		with io.BytesIO() as fakefile:
+			self._gen_epub(fakefile, basepath)
+			res = epubinfo.EpubFile(fakefile)
+			self.assertEqual([r.path for r in res.renditions], ["EPUB/package.opf", "EPUB/package-braille.opf"])
+			self.assertEqual(res.renditions[0].attributes, {})
+			self.assertEqual(res.renditions[1].attributes,
+				{"accessMode": "tactile", "label": "Pre-translated to braille"})
+			# The default (last) rendition is the book itself, others are parsed on demand
+			self.assertIs(res.renditions[1].book, res)
+			self.assertIsNone(res.renditions[0]._book)
+			book = res.renditions[0].book
+			self.assertIs(res.renditions[0].book, book)
+			self.assertIs(book._epubf, res._epubf)
+			self.assertEqual(book._opfpath, "EPUB/package.opf")
+			self.assertEqual(res._opfpath, "EPUB/package-braille.opf")
+			self.assertEqual(book.title, testdata.TEST_METADATA["WCAG"]["title"])
+			self.assertIn({"property": "dcterms:modified", "": "2014-12-11T09:12:55Z"}, book.meta)
+			self.assertIn({"property": "dcterms:modified", "": "2015-02-24T13:37:19Z"}, res.meta)
+
+			# Archive level warnings are kept for every rendition
+			res = epubinfo.EpubFile(fakefile, validate=True)
+			book = res.renditions[0].book
+			self.assertIn(("mimetype-missing", "mimetype"), [(w.code, w.path) for w in book.warnings])
+			self.assertEqual(res.warnings[0], book.warnings[0])
+
+		# Renditions of pooled books read through the per-thread handles of the book
+		import tempfile
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, "book.epub")
+			with open(path, "wb") as fd:
+				self._gen_epub(fd, basepath)
+			pool = epubinfo.EpubFilePool()
+			with pool.get(path) as pooled:
+				book = pooled.renditions[0].book
+				self.assertNotIn("_clones", vars(book))
+				self.assertIn("package", book.serialize_metadata())
+				self.assertEqual(pooled._numfds(), 2)
+			pool.close()
+
+	def test_library_index(self):
+		import tempfile, shutil
+		import epubinfo.library
+		datadir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+		with tempfile.TemporaryDirectory() as tmpdir:
+			bookdir = os.path.join(tmpdir, "books")
+			os.makedirs(os.path.join(bookdir, "sub"))
+			for testf, fn in [("moby-dick", "a.epub"), ("WCAG", "sub/b.epub"), ("covertest", "c.epub")]:
+				with open(os.path.join(bookdir, fn), "wb") as fd:
+					self._gen_epub(fd, os.path.join(datadir, testf))
+			with open(os.path.join(bookdir, "notes.txt"), "w") as fd:
+				fd.write("not a book")
+			statepath = os.path.join(tmpdir, "index.json")
+			apath, bpath, cpath = [os.path.join(bookdir, fn) for fn in ["a.epub", "sub/b.epub", "c.epub"]]
+
+			index = epubinfo.library.LibraryIndex(statepath, [bookdir], workers=2)
+			changes = index.update()
+			self.assertEqual(sorted(changes["new"]), sorted([apath, bpath, cpath]))
+			self.assertEqual(index.books[apath]["metadata"]["title"], testdata.TEST_METADATA["moby-dick"]["title"])
+
+			# A new index loads the state, and finds nothing to do
+			index = epubinfo.library.LibraryIndex(statepath, [bookdir], workers=0)
+			self.assertEqual(index.update(), {"new": [], "changed": [], "deleted": []})
+
+			# Touching a file does not re-extract it, replacing its contents does
+			os.utime(apath, ns=(0, 0))
+			shutil.copyfile(os.path.join(bookdir, "c.epub"), bpath)
+			os.unlink(cpath)
+			self.assertEqual(index.update(), {"new": [], "changed": [bpath], "deleted": [cpath]})
+			self.assertEqual(index.books[apath]["mtime"], 0)
+			self.assertEqual(index.books[bpath]["metadata"]["title"], testdata.TEST_METADATA["covertest"]["title"])
+			self.assertNotIn(cpath, epubinfo.library.LibraryIndex(statepath, [bookdir]).books)
+
+	def test_spine_reader_errors(self):
+		basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'moby-dick')
+		with io.BytesIO() as fakefile:
+			self._gen_epub(fakefile, basepath)
+			res = epubinfo.EpubFile(fakefile)
+			# Errors while prefetching are raised when the item is read
+			broken = res.spine[1]
+			def fail():
+				raise RuntimeError("boom")
+			broken.content = fail
+			reader = epubinfo.SpineReader(res, prefetch=1)
+			reader[0]
+			reader._executor.shutdown(wait=True)
+			self.assertIn(1, reader._errors)
+			with self.assertRaisesRegex(RuntimeError, "boom"):
+				reader[1]
+			self.assertNotIn(1, reader._errors)
+			reader.close()
+			with self.assertRaisesRegex(ValueError, "closed"):
+				reader[0]
+
+	def test_pool_thread_churn(self):
+		import tempfile, threading
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, "book.epub")
+			with open(path, "wb") as fd:
+				self._gen_epub(fd, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'moby-dick'))
+
+			pool = epubinfo.EpubFilePool(maxfds=16)
+			book = pool.acquire(path)
+			# Parsing does not open any extra descriptors
+			self.assertEqual(book._numfds(), 1)
+			maxseen = []
+			def worker():
+				book.serialize_metadata()
+				maxseen.append(book._numfds())
+			# Short-lived threads (like the socket server uses) in batches of 8
+			for _ in range(100 // 8 + 1):
+				threads = [threading.Thread(target=worker) for _ in range(8)]
+				for t in threads:
+					t.start()
+				for t in threads:
+					t.join()
+				self.assertLessEqual(book._numfds(), 16)
+			self.assertLessEqual(max(maxseen), 16)
+			self.assertGreater(max(maxseen), 1)
+			self.assertEqual(book._numfds(), 1)
+			pool.release(book)
+			pool.close()
+
+	def test_validate_zip_errors(self):
+		basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'covertest')
+		with io.BytesIO() as fakefile:
+			with zipfile.ZipFile(fakefile, "w") as zf:
+				zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+				for bpath, _, sfiles in os.walk(basepath):
+					for fn in sfiles:
+						zf.write(os.path.join(bpath, fn), os.path.join(bpath[len(basepath) + 1:], fn))
+				zf.writestr("odd.bin", "compressed with some unknown method")
+				zf.writestr("secret.bin", "encrypted data")
+				# Only the central directory is updated, that's what readers use
+				zf.getinfo("odd.bin").compress_type = 99
+				zf.getinfo("secret.bin").flag_bits |= 0x1
+			# Corrupt the mimetype content, so its CRC no longer matches
+			data = fakefile.getvalue().replace(b"application/epub+zip", b"application/epub+zap", 1)
+
+		# Without validation the book parses fine, with it nothing is raised either
+		epubinfo.EpubFile(io.BytesIO(data))
+		res = epubinfo.EpubFile(io.BytesIO(data), validate=True)
+		self.assertEqual([(w.code, w.path) for w in res.warnings], [("bad-crc", "mimetype")])
+		res = epubinfo.EpubFile(io.BytesIO(data), checkcrc=True)
+		self.assertEqual([(w.code, w.path) for w in res.warnings], [
+			("bad-crc", "mimetype"),
+			("unsupported-compression", "odd.bin"),
+			("encrypted", "secret.bin"),
+		])
+
+	def test_pool_close_after_read(self):
+		import tempfile
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, "book.epub")
+			with open(path, "wb") as fd:
+				self._gen_epub(fd, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'moby-dick'))
+			pool = epubinfo.EpubFilePool()
+			# Closing a book this thread has read from drops (and finalizes) its handle
+			with pool.get(path) as book:
+				book.serialize_metadata()
+				self.assertEqual(book._numfds(), 2)
+			pool.close()
+			self.assertEqual(book._numfds(), 1)
+
+	def test_library_index_worker_crash(self):
+		import multiprocessing
+		import epubinfo.library
+		if multiprocessing.get_start_method() != "fork":
+			self.skipTest("needs fork to inject the crash in the workers")
+		datadir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+		init = epubinfo.EpubFile.__init__
+		def crashing_init(self, fd, *args, **kwargs):
+			# The forked workers inherit the patch, a crash.epub kills them
+			if fd.name.endswith("crash.epub"):
+				os._exit(1)
+			init(self, fd, *args, **kwargs)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			names = ["a.epub", "b.epub", "crash.epub"] + ["%s.epub" % c for c in "defghij"]
+			paths = [os.path.join(tmpdir, fn) for fn in names]
+			for path in paths:
+				with open(path, "wb") as fd:
+					self._gen_epub(fd, os.path.join(datadir, "covertest"))
+			statepath = os.path.join(tmpdir, "index.json")
+
+			isolated = mock.patch.object(epubinfo.library.LibraryIndex, "_run_isolated",
+				autospec=True, side_effect=epubinfo.library.LibraryIndex._run_isolated)
+			with mock.patch.object(epubinfo.EpubFile, "__init__", crashing_init), isolated as run_isolated:
+				index = epubinfo.library.LibraryIndex(statepath, [tmpdir], workers=2)
+				self.assertEqual(sorted(index.update()["new"]), paths)
+			# Only the books that were running when the worker died are retried on their own
+			retried = [call.args[1] for call in run_isolated.call_args_list]
+			self.assertIn(paths[2], retried)
+			self.assertLessEqual(len(retried), 2)
+			# Only the book that killed its worker is marked as failed, and all is saved
+			books = epubinfo.library.LibraryIndex(statepath, [tmpdir]).books
+			self.assertIn("BrokenProcessPool", books[paths[2]]["error"])
+			for path in paths[:2] + paths[3:]:
+				self.assertEqual(books[path]["metadata"]["title"], testdata.TEST_METADATA["covertest"]["title"])
+
+			# A transient stat error does not drop the book from the index
+			stat = os.stat
+			def failing_stat(path, *args, **kwargs):
+				if path == paths[0]:
+					raise PermissionError(path)
+				return stat(path, *args, **kwargs)
+			with mock.patch("os.stat", failing_stat):
+				changes = index.update()
+			self.assertEqual(changes["deleted"], [])
+			self.assertIn(paths[0], index.books)
+
+		# A single book also runs in a worker
+		with tempfile.TemporaryDirectory() as tmpdir:
+			with open(os.path.join(tmpdir, "crash.epub"), "wb") as fd:
+				self._gen_epub(fd, os.path.join(datadir, "covertest"))
+			with mock.patch.object(epubinfo.EpubFile, "__init__", crashing_init):
+				index = epubinfo.library.LibraryIndex(os.path.join(tmpdir, "index.json"), [tmpdir], workers=1)
+				index.update()
+			self.assertIn("BrokenProcessPool", index.books[os.path.join(tmpdir, "crash.epub")]["error"])
+
+	def test_cli_serve(self):
+		import json, socket, signal, subprocess, sys, tempfile, time
+		basepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'moby-dick')
+		env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+		with tempfile.TemporaryDirectory() as tmpdir:
+			epubpath = os.path.join(tmpdir, "book.epub")
+			with open(epubpath, "wb") as fd:
+				self._gen_epub(fd, basepath)
+
+			# Refuses to clobber something that is not a socket
+			notasock = os.path.join(tmpdir, "notasock")
+			with open(notasock, "w") as fd:
+				fd.write("precious")
+			proc = subprocess.run([sys.executable, "-m", "epubinfo", "--serve", notasock],
+				env=env, stderr=subprocess.PIPE, timeout=30)
+			self.assertNotEqual(proc.returncode, 0)
+			self.assertIn(b"not a socket", proc.stderr)
+			with open(notasock) as fd:
+				self.assertEqual(fd.read(), "precious")
+
+			sockpath = os.path.join(tmpdir, "epubinfo.sock")
+			proc = subprocess.Popen([sys.executable, "-m", "epubinfo", "--serve", sockpath], env=env)
+			try:
+				for _ in range(200):
+					if os.path.exists(sockpath):
+						break
+					time.sleep(0.05)
+				with socket.socket(socket.AF_UNIX) as sock:
+					sock.connect(sockpath)
+					sock.sendall((epubpath + "\n" + os.path.join(tmpdir, "missing.epub") + "\n").encode("utf-8"))
+					with sock.makefile("rb") as rfile:
+						res = [json.loads(rfile.readline()) for _ in range(2)]
+				self.assertEqual(res[0]["file"], epubpath)
+				self.assertEqual(res[0]["title"], testdata.TEST_METADATA["moby-dick"]["title"])
+				self.assertIn("error", res[1])
+			finally:
+				proc.send_signal(signal.SIGTERM)
+				self.assertEqual(proc.wait(timeout=30), 0)
+			self.assertFalse(os.path.exists(sockpath))
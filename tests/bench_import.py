@@ -0,0 +1,48 @@
+# Startup time benchmark for short-lived processes
+#
+#   python -m tests.bench_import -n 20
+#
+# Times a bare interpreter, `import epubinfo` and a cold command line run over
+# one of the test books, each in a fresh process, and prints the numbers.
+
+import os, sys, time, tempfile, argparse, statistics, subprocess
+
+DATADIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def timeit(cmd, iterations):
+	"""Runs `cmd` several times, returns the list of wall times in seconds"""
+	env = dict(os.environ, PYTHONPATH=ROOTDIR)
+	ret = []
+	for _ in range(iterations):
+		start = time.perf_counter()
+		subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL)
+		ret.append(time.perf_counter() - start)
+	return ret
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="tests.bench_import", description="Benchmarks epubinfo startup time")
+	parser.add_argument("-n", "--iterations", type=int, default=20)
+	parser.add_argument("--book", default="moby-dick", help="Test book used for the CLI run")
+	args = parser.parse_args(argv)
+
+	from tests import EpubTestFiles
+	with tempfile.TemporaryDirectory() as tmpdir:
+		epubpath = os.path.join(tmpdir, "book.epub")
+		with open(epubpath, "wb") as fd:
+			EpubTestFiles._gen_epub(fd, os.path.join(DATADIR, args.book))
+
+		cases = [
+			("python -c pass", [sys.executable, "-c", "pass"]),
+			("import epubinfo", [sys.executable, "-c", "import epubinfo"]),
+			("python -m epubinfo", [sys.executable, "-m", "epubinfo", epubpath]),
+		]
+		print("%-20s %10s %10s %10s" % ("case", "min (ms)", "median", "mean"))
+		for name, cmd in cases:
+			times = timeit(cmd, args.iterations)
+			print("%-20s %10.1f %10.1f %10.1f" % (name, min(times) * 1000,
+				statistics.median(times) * 1000, statistics.mean(times) * 1000))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,372 @@
+# Fuzzing and stress harness for the epub parser
+#
+#   python -m tests.fuzz -n 2000 --seed 1 --corpus tests/fuzz-corpus
+#   python -m tests.fuzz --replay tests/fuzz-corpus
+#
+# Books from tests/data are mutated (container, OPF, NCX and the ZIP structure
+# itself) and processed through EpubFile, serialize_metadata and write_epub.
+# Any exception other than EpubInfoException is reported, as well as inputs
+# that are too slow or use too much memory. Those inputs are saved in the
+# corpus directory, so they can be replayed later as regression benchmarks.
+# Errors are only kept once per exception type and raising frame.
+#
+# Cases run in a worker process: inputs that hang (past --timeout) or kill
+# the interpreter (segfaults, OOM kills...) are reported too, and the worker
+# is restarted. Replaying compares every input against the outcome and time
+# recorded when it was saved, and reports the regressions.
+
+import os, io, sys, time, random, signal, zipfile, argparse, tracemalloc, traceback, hashlib
+import multiprocessing
+import epubinfo
+
+DATADIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+
+def build_seeds():
+	"""Returns a dict of fixture name to a dict of ZIP member name -> bytes"""
+	ret = {}
+	for testf in sorted(os.listdir(DATADIR)):
+		basepath = os.path.join(DATADIR, testf)
+		members = {}
+		for bpath, _, sfiles in os.walk(basepath):
+			for fn in sorted(sfiles):
+				with open(os.path.join(bpath, fn), "rb") as fd:
+					members[os.path.join(bpath[len(basepath) + 1:], fn)] = fd.read()
+		ret[testf] = members
+	return ret
+
+def pack(members, compression=zipfile.ZIP_STORED):
+	with io.BytesIO() as out:
+		with zipfile.ZipFile(out, "w", compression=compression) as zf:
+			for name, data in members.items():
+				zf.writestr(name, data)
+		return out.getvalue()
+
+# XML level mutations, all of them take (rnd, bytes) and return bytes
+
+def _mut_flip(rnd, data):
+	if not data:
+		return data
+	data = bytearray(data)
+	for _ in range(rnd.randint(1, 8)):
+		data[rnd.randrange(len(data))] = rnd.randrange(256)
+	return bytes(data)
+
+def _mut_truncate(rnd, data):
+	return data[:rnd.randint(0, len(data))]
+
+def _mut_delete(rnd, data):
+	if not data:
+		return data
+	pos = rnd.randrange(len(data))
+	return data[:pos] + data[pos + rnd.randint(1, 64):]
+
+def _mut_duplicate(rnd, data):
+	# Duplicates a chunk of the document (usually yields duplicated elements)
+	if not data:
+		return data
+	start = rnd.randrange(len(data))
+	end = min(len(data), start + rnd.randint(1, 512))
+	return data[:end] + data[start:end] * rnd.randint(1, 64) + data[end:]
+
+def _mut_nesting(rnd, data):
+	# Deeply nested elements right after the first closing tag
+	depth = rnd.choice([100, 1000, 10000])
+	tag = rnd.choice([b"navPoint", b"item", b"metadata", b"x"])
+	blob = (b"<" + tag + b">") * depth + (b"</" + tag + b">") * depth
+	pos = data.find(b">") + 1
+	return data[:pos] + blob + data[pos:]
+
+def _mut_attrs(rnd, data):
+	# Huge attribute values or element counts
+	if rnd.random() < 0.5:
+		blob = b'<meta name="x" content="' + b"A" * rnd.choice([10 ** 4, 10 ** 6]) + b'"/>'
+	else:
+		blob = b'<meta property="p" refines="#c">v</meta>' * rnd.choice([1000, 20000])
+	pos = data.rfind(b"</metadata>")
+	if pos < 0:
+		pos = len(data) // 2
+	return data[:pos] + blob + data[pos:]
+
+def _mut_entities(rnd, data):
+	# Entity expansion (billion laughs style, the parser should reject it)
+	dtd = b'<!DOCTYPE x [<!ENTITY a "aaaaaaaaaa">' + b"".join(
+		b'<!ENTITY %c "%s">' % (98 + i, (b"&%c;" % (97 + i)) * 10) for i in range(rnd.randint(1, 8))) + b"]>"
+	pos = data.find(b"?>")
+	pos = pos + 2 if pos >= 0 else 0
+	return data[:pos] + dtd + data[pos:].replace(b"</metadata>", b"<x>&b;</x></metadata>", 1)
+
+XML_MUTATORS = [_mut_flip, _mut_truncate, _mut_delete, _mut_duplicate, _mut_nesting, _mut_attrs, _mut_entities]
+
+# ZIP level mutations, operate on the packed archive
+
+def _zip_flip(rnd, data):
+	return _mut_flip(rnd, data)
+
+def _zip_truncate(rnd, data):
+	return data[:rnd.randint(len(data) // 2, len(data))]
+
+def _zip_central_dir(rnd, data):
+	# Corrupts bytes in the central directory / end of central directory
+	pos = data.rfind(b"PK\x01\x02")
+	if pos < 0:
+		return _mut_flip(rnd, data)
+	data = bytearray(data)
+	for _ in range(rnd.randint(1, 4)):
+		data[rnd.randrange(pos, len(data))] = rnd.randrange(256)
+	return bytes(data)
+
+def _zip_crc(rnd, data):
+	# Corrupts the CRC of a local file header (bytes 14-18)
+	positions = []
+	pos = data.find(b"PK\x03\x04")
+	while pos >= 0:
+		positions.append(pos)
+		pos = data.find(b"PK\x03\x04", pos + 4)
+	if not positions:
+		return data
+	pos = rnd.choice(positions) + 14
+	return data[:pos] + bytes(rnd.randrange(256) for _ in range(4)) + data[pos + 4:]
+
+ZIP_MUTATORS = [_zip_flip, _zip_truncate, _zip_central_dir, _zip_crc]
+
+def mutate(rnd, seeds):
+	"""Generates a (description, epub bytes) tuple from a random seed book"""
+	name = rnd.choice(sorted(seeds))
+	members = dict(seeds[name])
+	desc = [name]
+	if rnd.random() < 0.7:
+		targets = [m for m in members if m.endswith((".xml", ".opf", ".ncx"))]
+		for _ in range(rnd.randint(1, 3)):
+			target = rnd.choice(targets)
+			mut = rnd.choice(XML_MUTATORS)
+			members[target] = mut(rnd, members[target])
+			desc.append("%s:%s" % (target, mut.__name__))
+		data = pack(members, rnd.choice([zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]))
+	else:
+		mut = rnd.choice(ZIP_MUTATORS)
+		data = mut(rnd, pack(members, rnd.choice([zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])))
+		desc.append("zip:%s" % mut.__name__)
+	return " ".join(desc), data
+
+def run_case(data, trackmem=True):
+	"""
+	Runs one input through the library.
+
+	Returns a dict with the outcome ("ok", "rejected" or "error"), the error
+	description and signature (exception type and raising frame, if any), the
+	elapsed time in seconds and peak memory in bytes. Tracking memory slows
+	down execution considerably (and skews timings).
+	"""
+	outcome, error, signature, peak = "ok", None, None, 0
+	if trackmem:
+		tracemalloc.start()
+	start = time.perf_counter()
+	try:
+		book = epubinfo.EpubFile(io.BytesIO(data), getcover=True)
+		for sobj in book.spine:
+			sobj.content()
+		book.to_dict()
+		book.serialize_metadata()
+		with io.BytesIO() as out:
+			book.write_epub(out)
+	except epubinfo.EpubInfoException as e:
+		outcome, error = "rejected", str(e)
+	except Exception as e:
+		outcome, error = "error", traceback.format_exc(limit=4)
+		frame = traceback.extract_tb(e.__traceback__)[-1]
+		signature = "%s at %s:%d" % (type(e).__name__, os.path.basename(frame.filename), frame.lineno)
+	finally:
+		elapsed = time.perf_counter() - start
+		if trackmem:
+			_, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+	return {"outcome": outcome, "error": error, "signature": signature, "time": elapsed, "memory": peak}
+
+def _worker(conn, trackmem):
+	# Worker process loop: reads inputs from the pipe, sends back the results
+	while True:
+		try:
+			data = conn.recv_bytes()
+		except EOFError:
+			return
+		conn.send(run_case(data, trackmem))
+
+class CaseRunner(object):
+	"""
+	Runs cases (see `run_case`) in a worker process.
+
+	Inputs that take longer than `timeout` seconds get a "timeout" outcome,
+	and those that make the worker exit get a "crash" outcome. The worker is
+	restarted (lazily) in both cases.
+	"""
+	def __init__(self, timeout=10.0, trackmem=True):
+		self._timeout = timeout
+		self._trackmem = trackmem
+		self._proc, self._conn = None, None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _start(self):
+		# Forking is much cheaper, and the worker sees the same (patched) modules
+		methods = multiprocessing.get_all_start_methods()
+		ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+		self._conn, child = ctx.Pipe()
+		self._proc = ctx.Process(target=_worker, args=(child, self._trackmem), daemon=True)
+		self._proc.start()
+		child.close()
+
+	def _stop(self):
+		self._conn.close()
+		if self._proc.is_alive():
+			self._proc.kill()
+		self._proc.join()
+		code = self._proc.exitcode
+		self._proc, self._conn = None, None
+		return code
+
+	def close(self):
+		if self._proc is not None:
+			self._stop()
+
+	def run(self, data):
+		if self._proc is None:
+			self._start()
+		start = time.perf_counter()
+		try:
+			self._conn.send_bytes(data)
+			if self._conn.poll(self._timeout):
+				return self._conn.recv()
+			outcome = "timeout"
+		except (EOFError, OSError):
+			outcome = "crash"
+		elapsed = time.perf_counter() - start
+		code = self._stop()
+		if outcome == "timeout":
+			return {"outcome": outcome, "error": "No result after %.1fs" % self._timeout,
+				"signature": "timeout", "time": elapsed, "memory": 0}
+		if code < 0:
+			error = "Worker killed by %s" % signal.Signals(-code).name
+		else:
+			error = "Worker exited with code %d" % code
+		return {"outcome": outcome, "error": error, "signature": error, "time": elapsed, "memory": 0}
+
+def save_case(corpus, data, desc, res):
+	os.makedirs(corpus, exist_ok=True)
+	name = hashlib.sha256(data).hexdigest()[:16]
+	with open(os.path.join(corpus, name + ".epub"), "wb") as fd:
+		fd.write(data)
+	with open(os.path.join(corpus, name + ".txt"), "w") as fd:
+		fd.write("%s\n%s %.3fs %d bytes\n%s\n" % (desc, res["outcome"], res["time"], res["memory"], res["error"] or ""))
+
+def load_case(corpus, name):
+	"""
+	Returns the (outcome, time, memory) recorded for a saved input, None if
+	there is no record. Memory is 0 if it was not tracked.
+	"""
+	try:
+		with open(os.path.join(corpus, name + ".txt"), "r") as fd:
+			fd.readline()
+			outcome, elapsed, memory, _ = fd.readline().split(" ", 3)
+	except (OSError, ValueError):
+		return None
+	return outcome, float(elapsed.rstrip("s")), int(memory)
+
+def triage(res, maxtime, maxmem, seen):
+	"""
+	Returns whether a result is worth keeping: time/memory outliers (and so
+	timeouts) always are, errors and crashes only the first time their
+	signature is seen (added to `seen`).
+	"""
+	if res["outcome"] == "timeout" or res["time"] > maxtime or res["memory"] > maxmem:
+		return True
+	if res["outcome"] in ("error", "crash") and res["signature"] not in seen:
+		seen.add(res["signature"])
+		return True
+	return False
+
+def fuzz(iterations, seed=0, maxtime=1.0, maxmem=64 * 1024 * 1024, corpus=None, log=None, trackmem=True,
+		timeout=10.0):
+	"""
+	Runs the fuzzer, returns a list of (description, data, result) for every
+	input that exceeded the time/memory limits or timed out, and for the first
+	input of every distinct unexpected error or worker crash.
+	"""
+	rnd = random.Random(seed)
+	seeds = build_seeds()
+	findings, seen = [], set()
+	with CaseRunner(timeout, trackmem) as runner:
+		for i in range(iterations):
+			desc, data = mutate(rnd, seeds)
+			res = runner.run(data)
+			if triage(res, maxtime, maxmem, seen):
+				findings.append((desc, data, res))
+				if corpus:
+					save_case(corpus, data, desc, res)
+				if log:
+					log.write("[%d] %s: %s %.3fs %.1fMB\n%s\n" % (i, desc, res["outcome"],
+						res["time"], res["memory"] / 1048576.0, res["error"] or ""))
+	return findings
+
+def replay(corpus, log, trackmem=True, timeout=10.0, slowdown=2.0):
+	"""
+	Runs all the inputs in the corpus and prints their timings.
+
+	Returns a list of (file name, reason) for the inputs that regressed since
+	they were saved: a failure where there was none, or a time (and memory,
+	if tracked both times) above `slowdown` times the recorded one. Timings
+	recorded while tracking memory are only compared to tracked runs.
+	"""
+	regressions = []
+	with CaseRunner(timeout, trackmem) as runner:
+		for fn in sorted(os.listdir(corpus)):
+			if not fn.endswith(".epub"):
+				continue
+			with open(os.path.join(corpus, fn), "rb") as fd:
+				res = runner.run(fd.read())
+			log.write("%s %s %.3fs %.1fMB\n" % (fn, res["outcome"], res["time"], res["memory"] / 1048576.0))
+			recorded = load_case(corpus, fn[:-len(".epub")])
+			if recorded is None:
+				continue
+			outcome, elapsed, memory = recorded
+			reasons = []
+			if outcome in ("ok", "rejected") and res["outcome"] not in ("ok", "rejected"):
+				reasons.append("%s, was %s" % (res["outcome"], outcome))
+			# Ignore differences within timer/scheduling noise
+			if (trackmem or not memory) and res["time"] > max(elapsed * slowdown, elapsed + 0.01):
+				reasons.append("%.3fs, was %.3fs" % (res["time"], elapsed))
+			if trackmem and memory and res["memory"] > memory * slowdown:
+				reasons.append("%.1fMB, was %.1fMB" % (res["memory"] / 1048576.0, memory / 1048576.0))
+			if reasons:
+				regressions.append((fn, "; ".join(reasons)))
+				log.write("REGRESSION %s: %s\n" % (fn, "; ".join(reasons)))
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="tests.fuzz", description="Fuzzes the epubinfo parser")
+	parser.add_argument("-n", "--iterations", type=int, default=1000)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--max-time", type=float, default=1.0, help="Slow input threshold (seconds)")
+	parser.add_argument("--max-mem", type=int, default=64, help="Memory hungry input threshold (MB)")
+	parser.add_argument("--no-mem", action="store_true", help="Do not track memory usage (faster)")
+	parser.add_argument("--timeout", type=float, default=10.0, help="Hung input threshold (seconds)")
+	parser.add_argument("--slowdown", type=float, default=2.0,
+		help="Replay: report inputs this many times slower than recorded")
+	parser.add_argument("--corpus", help="Directory to store failing and slow inputs in")
+	parser.add_argument("--replay", metavar="CORPUS", help="Replay the inputs of a corpus directory")
+	args = parser.parse_args(argv)
+
+	if args.replay:
+		regressions = replay(args.replay, sys.stdout, not args.no_mem, args.timeout, args.slowdown)
+		print("%d regressions" % len(regressions))
+		return 1 if regressions else 0
+	findings = fuzz(args.iterations, args.seed, args.max_time, args.max_mem * 1024 * 1024,
+		args.corpus, sys.stdout, not args.no_mem, args.timeout)
+	print("%d inputs, %d findings" % (args.iterations, len(findings)))
+	return 1 if findings else 0
+
+if __name__ == "__main__":
+	sys.exit(main())